@@ -11,15 +11,17 @@ Test storage of analysis statistics.
 """
 
 
+import io
 import multiprocessing
 import json
 import os
 import shutil
 import subprocess
+import threading
 import unittest
+import uuid
 import zipfile
 
-from tempfile import TemporaryDirectory
 from codechecker_api.codeCheckerDBAccess_v6.ttypes import RunFilter
 
 
@@ -27,15 +29,17 @@ from libtest import codechecker
 from libtest import env
 
 
-def extract(zip_file, output_dir):
-    with zipfile.ZipFile(zip_file, 'r', allowZip64=True) as zipf:
-        try:
-            zipf.extractall(output_dir)
-        except Exception:
-            print("Failed to extract received ZIP.")
-            import traceback
-            traceback.print_exc()
-            raise
+# Versions of the analyzed source file.
+SOURCES = (b"""
+int main()
+{
+  return 1 / 0; // Division by zero
+}""", b"""
+int main()
+{
+  return 0;
+  xxx // Will cause a compilation error
+}""")
 
 
 class TestStorageOfAnalysisStatistics(unittest.TestCase):
@@ -82,6 +86,48 @@ class TestStorageOfAnalysisStatistics(unittest.TestCase):
         # Export configuration for the tests.
         env.export_test_cfg(TEST_WORKSPACE, test_config)
 
+        # The exported configuration does not change during the tests so it
+        # is imported only once.
+        self._cfg_cache = env.import_codechecker_cfg(TEST_WORKSPACE)
+
+        # Init project dir. These files do not change between the test
+        # cases so they are written only once.
+        test_dir = os.path.join(TEST_WORKSPACE, 'test_files')
+        os.makedirs(test_dir)
+
+        source_file = os.path.join(test_dir, "main.cpp")
+
+        makefile_content = "all:\n\t$(CXX) -c main.cpp -o /dev/null\n"
+        project_info_content = {
+            "name": "hello",
+            "clean_cmd": "",
+            "build_cmd": "make"
+        }
+
+        makefile = os.path.join(test_dir, 'Makefile')
+        with open(makefile, 'w', encoding="utf-8", errors="ignore") as make_f:
+            make_f.write(makefile_content)
+
+        project_info = os.path.join(test_dir, 'project_info.json')
+        with open(project_info, 'wb') as info_f:
+            info_f.write(json.dumps(project_info_content).encode('utf-8'))
+
+        # Create a compilation database.
+        build_log = [
+            {
+                "directory": TEST_WORKSPACE,
+                "command": "clang -c " + source_file,
+                "file": source_file
+            }
+        ]
+
+        build_json = os.path.join(test_dir, "build.json")
+        with open(build_json, 'wb') as outfile:
+            outfile.write(json.dumps(build_log).encode('utf-8'))
+
+        # Report directories of the analyzed source versions.
+        self._analysis_cache = {}
+
         # Enable storage of analysis statistics and start the CodeChecker
         # server.
         env.enable_storage_of_analysis_statistics(TEST_WORKSPACE)
@@ -91,6 +137,13 @@ class TestStorageOfAnalysisStatistics(unittest.TestCase):
         server_access['viewer_product'] = codechecker_cfg['viewer_product']
         codechecker.add_test_package_product(server_access, TEST_WORKSPACE)
 
+        # Setup a viewer client to test viewer API calls. The client is
+        # shared between the test cases.
+        self._cc_client = env.setup_viewer_client(TEST_WORKSPACE)
+
+        # Get the CodeChecker cmd if needed for the tests.
+        self._codechecker_cmd = env.codechecker_cmd()
+
     def teardown_class(self):
         """Stop the CodeChecker server and clean up after the tests."""
 
@@ -105,8 +158,18 @@ class TestStorageOfAnalysisStatistics(unittest.TestCase):
         # Let the remaining CodeChecker servers die.
         EVENT_1.set()
 
+        # Move the workspace away and remove it in the background so the
+        # remaining tests do not have to wait for the cleanup.
         print("Removing: " + TEST_WORKSPACE)
-        shutil.rmtree(TEST_WORKSPACE, ignore_errors=True)
+        trash_dir = TEST_WORKSPACE + '.trash.' + uuid.uuid4().hex
+        try:
+            os.rename(TEST_WORKSPACE, trash_dir)
+        except OSError:
+            trash_dir = TEST_WORKSPACE
+
+        threading.Thread(target=shutil.rmtree,
+                         args=(trash_dir,),
+                         kwargs={'ignore_errors': True}).start()
 
     def setup_method(self, method):
 
@@ -116,31 +179,22 @@ class TestStorageOfAnalysisStatistics(unittest.TestCase):
         test_class = self.__class__.__name__
         print('Running ' + test_class + ' tests in ' + self.test_workspace)
 
-        self._codechecker_cfg = env.import_codechecker_cfg(self.test_workspace)
+        # Test cases may modify their configuration.
+        self._codechecker_cfg = self._cfg_cache.copy()
         self._reports_dir = self._codechecker_cfg['reportdir']
 
-        # Get the CodeChecker cmd if needed for the tests.
-        self._codechecker_cmd = env.codechecker_cmd()
         self._test_dir = os.path.join(self.test_workspace, 'test_files')
         self._product_name = self._codechecker_cfg['viewer_product']
         self._analyzer_stats_dir = os.path.join(self.test_workspace,
                                                 'analysis_statistics')
-        try:
-            os.makedirs(self._test_dir)
-        except os.error:
-            # Directory already exists.
-            pass
+        os.makedirs(self._test_dir, exist_ok=True)
 
         # Remove analyzer statistics directory if it exists before store.
-        if os.path.exists(self._analyzer_stats_dir):
-            shutil.rmtree(self._analyzer_stats_dir, ignore_errors=True)
+        shutil.rmtree(self._analyzer_stats_dir, ignore_errors=True)
 
-        # Remove reports directory if it exists and create an empty one.
-        if os.path.exists(self._reports_dir):
-            shutil.rmtree(self._reports_dir, ignore_errors=True)
+        # Remove reports directory if it exists.
+        shutil.rmtree(self._reports_dir, ignore_errors=True)
 
-        # Setup a viewer client to test viewer API calls.
-        self._cc_client = env.setup_viewer_client(self.test_workspace)
         self.assertIsNotNone(self._cc_client)
 
         # Change working dir to testfile dir so CodeChecker can be run easily.
@@ -148,34 +202,9 @@ class TestStorageOfAnalysisStatistics(unittest.TestCase):
         os.chdir(self._test_dir)
 
         self._source_file = os.path.join(self._test_dir, "main.cpp")
+        self._build_json = os.path.join(self._test_dir, "build.json")
 
-        # Init project dir.
-        makefile_content = "all:\n\t$(CXX) -c main.cpp -o /dev/null\n"
-        project_info_content = {
-            "name": "hello",
-            "clean_cmd": "",
-            "build_cmd": "make"
-        }
-
-        makefile = os.path.join(self._test_dir, 'Makefile')
-        with open(makefile, 'w', encoding="utf-8", errors="ignore") as make_f:
-            make_f.write(makefile_content)
-
-        project_info = os.path.join(self._test_dir, 'project_info.json')
-        with open(project_info, 'w',
-                  encoding="utf-8", errors="ignore") as info_f:
-            json.dump(project_info_content, info_f)
-
-        self.sources = ["""
-int main()
-{
-  return 1 / 0; // Division by zero
-}""", """
-int main()
-{
-  return 0;
-  xxx // Will cause a compilation error
-}"""]
+        self.sources = SOURCES
 
     def teardown_method(self, method):
         """Restore environment after tests have ran."""
@@ -189,43 +218,34 @@ int main()
         self.assertTrue(ret)
 
     def _create_source_file(self, version, report_dir):
-        with open(self._source_file, 'w',
-                  encoding='utf-8', errors='ignore') as source_f:
+        with open(self._source_file, 'wb') as source_f:
             source_f.write(self.sources[version])
 
-        build_json = os.path.join(self._test_dir, "build.json")
+        # Analyzing the same source version always gives the same results,
+        # so the analysis is run only once and the report directory is
+        # copied for the subsequent calls.
+        cached_report_dir = self._analysis_cache.get(version)
+        if cached_report_dir is None:
+            cached_report_dir = os.path.join(
+                self.test_workspace, '_analysis_cache', f"v{version}")
 
-        # Create a compilation database.
-        build_log = [
-            {
-                "directory": self.test_workspace,
-                "command": "gcc -c " + self._source_file,
-                "file": self._source_file
-            },
-            {
-                "directory": self.test_workspace,
-                "command": "clang -c " + self._source_file,
-                "file": self._source_file
-            }
-        ]
+            # Create analyze command.
+            analyze_cmd = [self._codechecker_cmd, "analyze",
+                           self._build_json, "--analyzers", "clangsa",
+                           "-o", cached_report_dir]
 
-        with open(build_json, 'w',
-                  encoding="utf-8", errors="ignore") as outfile:
-            json.dump(build_log, outfile)
+            # Run analyze. The output of the analysis is not used by the
+            # tests so it is dropped instead of being buffered in memory.
+            subprocess.run(
+                analyze_cmd,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                cwd=self._test_dir,
+                check=False)
 
-        # Create analyze command.
-        analyze_cmd = [self._codechecker_cmd, "analyze", build_json,
-                       "--analyzers", "clangsa", "-o", report_dir]
+            self._analysis_cache[version] = cached_report_dir
 
-        # Run analyze.
-        process = subprocess.Popen(
-            analyze_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=self._test_dir,
-            encoding="utf-8",
-            errors="ignore")
-        process.communicate()
+        shutil.copytree(cached_report_dir, report_dir)
 
     def _check_analyzer_statistics_zip(self, run_name, report_dir):
         """
@@ -242,23 +262,31 @@ int main()
         self.assertTrue(os.listdir(product_stat_dir))
 
         zip_file = os.path.join(product_stat_dir, f"{run_name}.zip")
-        with TemporaryDirectory() as zip_dir:
-            extract(zip_file, zip_dir)
-
-            # Check that analyzer files exist in the uploaded zip.
-            analyzer_files = ['compile_cmd.json',
-                              'compiler_info.json',
-                              'metadata.json']
-            for analyzer_file in analyzer_files:
-                orig_file = os.path.join(report_dir, analyzer_file)
-                uploaded_file = os.path.join(zip_dir, orig_file.lstrip(os.sep))
-                self.assertTrue(os.path.exists(uploaded_file))
-
-            # Check that failed zips exist in the uploaded zip.
-            orig_failed_dir = os.path.join(report_dir, 'failed')
-            if os.path.exists(orig_failed_dir):
-                failed_dir = os.path.join(zip_dir, orig_failed_dir)
-                self.assertTrue(os.path.exists(failed_dir))
+        with open(zip_file, 'rb') as zip_f:
+            zip_data = io.BytesIO(zip_f.read())
+
+        with zipfile.ZipFile(zip_data, 'r', allowZip64=True) as zipf:
+            names = zipf.NameToInfo
+
+        # Files are stored in the zip by their absolute path without the
+        # leading separator, so checking the member names is enough, there
+        # is no need to extract the archive. Zip member names always use
+        # '/' as separator.
+        rel_report_dir = report_dir.lstrip(os.sep).replace(os.sep, '/')
+
+        # Check that analyzer files exist in the uploaded zip.
+        analyzer_files = {f"{rel_report_dir}/{analyzer_file}"
+                          for analyzer_file in ['compile_cmd.json',
+                                                'compiler_info.json',
+                                                'metadata.json']}
+        missing = analyzer_files - names.keys()
+        self.assertFalse(missing, f"Missing from the zip: {missing}")
+
+        # Check that failed zips exist in the uploaded zip.
+        orig_failed_dir = os.path.join(report_dir, 'failed')
+        if os.path.exists(orig_failed_dir):
+            failed_prefix = f"{rel_report_dir}/failed/"
+            self.assertTrue(any(n.startswith(failed_prefix) for n in names))
 
     def test_storage_empty_report_dir(self):
         """
@@ -327,9 +355,8 @@ int main()
         failed_file_info = failed_files[self._source_file]
         self.assertEqual(len(failed_file_info), 2)
 
-        self.assertTrue(
-            all(i.runName in ['statistics1', 'statistics2']
-                for i in failed_file_info))
+        self.assertEqual({i.runName for i in failed_file_info},
+                         {'statistics1', 'statistics2'})
 
         self._remove_run(['statistics1', 'statistics2'])
 